@@ -1,4 +1,10 @@
-from unittest import TestCase, mock
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+import numpy as np
+from PIL import Image
 
 from vncdotool import client, rfb
 
@@ -226,3 +232,225 @@ class TestVNCDoToolFactory(TestCase):
         self.factory.clientConnectionFailed(connector, reason)
 
         deferred.errback.assert_called_once_with(reason)
+
+
+class TestRefreshScreen(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = client.VNCDoToolClient()
+        self.client.width, self.client.height = 4, 4
+
+    async def test_cancelled_waiter(self) -> None:
+        cli = self.client
+        first = asyncio.create_task(cli.refreshScreen())
+        second = asyncio.create_task(cli.refreshScreen())
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        # the other waiter is still resolved by the update
+        await cli.commitUpdate([(0, 0, 4, 4)])
+        assert await second is cli
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+        # and later requests wait for the next update again
+        third = asyncio.create_task(cli.refreshScreen())
+        await asyncio.sleep(0)
+        assert not third.done()
+        await cli.commitUpdate([(0, 0, 4, 4)])
+        assert await third is cli
+
+
+class TestExpectCompare(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = cli = client.VNCDoToolClient()
+        cli.width, cli.height = 8, 8
+        cli._fb = np.full((8, 8, 3), 255, dtype=np.uint8)
+        cli._fb[:4, :4] = 0
+        cli._expected_np = cli._histogram((0, 0, 4, 4))
+        cli._fb[:] = 255
+
+    async def test_match_in_earlier_update(self) -> None:
+        cli = self.client
+        task = asyncio.create_task(cli._expectCompare((0, 0, 4, 4), 0))
+        await asyncio.sleep(0)
+        assert not task.done()
+        # two updates are handled before the compare loop runs again, only the
+        # first one touches the region
+        cli._fb[:4, :4] = 0
+        await cli.commitUpdate([(0, 0, 4, 4)])
+        await cli.commitUpdate([(6, 6, 2, 2)])
+        await asyncio.wait_for(task, 1)
+
+    async def test_skip_untouched_region(self) -> None:
+        cli = self.client
+        task = asyncio.create_task(cli._expectCompare((0, 0, 4, 4), 0))
+        await asyncio.sleep(0)
+        cli._fb[:4, :4] = 0  # not announced, so it is not looked at
+        await cli.commitUpdate([(6, 6, 2, 2)])
+        await asyncio.sleep(0)
+        assert not task.done()
+        await cli.commitUpdate([(2, 2, 2, 2)])
+        await asyncio.wait_for(task, 1)
+        assert cli._pending_rects is None
+
+    async def test_cursor_change(self) -> None:
+        cli = self.client
+        cli.image_mode = "RGBX"
+        task = asyncio.create_task(cli._expectCompare((4, 4, 8, 8), 0))
+        await asyncio.sleep(0)
+        # a black cursor drawn over the region, its rectangle holds the hotspot
+        cli.x, cli.y = 4, 4
+        await cli.updateCursor(0, 0, 4, 4, bytes(4 * 4 * 4), b"\xf0" * 4)
+        await cli.commitUpdate([(0, 0, 4, 4)])
+        await asyncio.wait_for(task, 1)
+
+
+class TestExpectRegionConnected(IsolatedAsyncioTestCase):
+
+    SERVER_INIT = (
+        b"RFB 003.008\n"
+        b"\x01\x01"  # one security type: NONE
+        b"\x00\x00\x00\x00"  # security result OK
+        + rfb._SERVER_INIT.pack(8, 8, client.RGB32.to_bytes(), 0)
+    )
+
+    async def asyncSetUp(self) -> None:
+        self.reader = asyncio.StreamReader()
+        self.writer = mock.Mock()
+        self.writer.is_closing.return_value = False
+        self.client = client.VNCDoToolClient()
+        await self.client.connect(self.reader, self.writer)
+        self.reader.feed_data(self.SERVER_INIT)
+
+    async def asyncTearDown(self) -> None:
+        await self.client.disconnect()
+
+    async def test_match(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "red.png")
+            Image.new("RGB", (4, 4), (255, 0, 0)).save(fname)
+            task = asyncio.create_task(self.client.expectRegion(fname, 2, 2))
+            await asyncio.sleep(0.01)
+            assert not task.done()
+            self.reader.feed_data(
+                b"\x00\x00\x00\x01"  # FramebufferUpdate, 1 rectangle
+                + rfb._RECTANGLE.pack(0, 0, 8, 8, rfb.Encoding.RAW)
+                + b"\xff\x00\x00\x00" * 64
+            )
+            assert await asyncio.wait_for(task, 1) is self.client
+        # the receive loop is waiting for the next message
+        assert self.client._expected_len == 1
+        assert self.client._packet_read == len(self.client._packet)
+
+
+class TestFramebuffer(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = cli = client.VNCDoToolClient()
+        cli.image_mode = "RGBX"
+        cli.width, cli.height = 4, 3
+
+    async def test_update(self) -> None:
+        cli = self.client
+        await cli.beginUpdate()
+        assert cli._fb is not None and cli._fb.shape == (3, 4, 3)
+        await cli.updateRectangle(1, 1, 2, 1, b"\x01\x02\x03\x00\x04\x05\x06\x00")
+        await cli.commitUpdate([(1, 1, 2, 1)])
+        assert cli.screen is not None
+        assert cli.screen.size == (4, 3)
+        assert cli.screen.getpixel((1, 1)) == (1, 2, 3)
+        assert cli.screen.getpixel((2, 1)) == (4, 5, 6)
+        assert cli.screen.getpixel((0, 0)) == (0, 0, 0)
+
+    async def test_grow(self) -> None:
+        cli = self.client
+        await cli.beginUpdate()
+        await cli.updateRectangle(0, 0, 1, 1, b"\x01\x02\x03\x00")
+        # an update beyond the announced size keeps the existing content
+        await cli.updateRectangle(5, 1, 1, 4, b"\x07\x08\x09\x00" * 4)
+        assert cli._fb is not None and cli._fb.shape == (5, 6, 3)
+        assert (cli.width, cli.height) == (6, 5)
+        assert cli._fb[0, 0].tolist() == [1, 2, 3]
+        assert cli._fb[4, 5].tolist() == [7, 8, 9]
+        assert not cli._fb[4, 4].any()
+
+
+class TestDecodePixels(TestCase):
+
+    def check(self, mode: str, bypp: int) -> None:
+        cli = client.VNCDoToolClient()
+        cli.image_mode = mode
+        data = np.random.default_rng(0).bytes(5 * 3 * bypp)
+        expected = Image.frombytes("RGB", (5, 3), data, "raw", mode)
+        assert (cli._decodePixels(data, 5, 3) == np.asarray(expected)).all()
+
+    def test_raw_layouts(self) -> None:
+        for mode, bypp in [("RGB", 3), ("BGR", 3), ("RGBX", 4), ("BGRX", 4)]:
+            self.check(mode, bypp)
+
+    def test_bgr16(self) -> None:
+        self.check("BGR;16", 2)
+
+    def test_other(self) -> None:
+        self.check("BGR;15", 2)
+
+
+class TestHistogram(TestCase):
+
+    def test_like_crop(self) -> None:
+        cli = client.VNCDoToolClient()
+        cli._fb = np.random.default_rng(0).integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(cli._fb)
+        for box in [
+            (0, 0, 8, 6),
+            (2, 1, 5, 4),
+            (6, 4, 10, 9),  # beyond the right and bottom edge
+            (-5, -5, 10, 10),
+            (-3, 2, 2, 4),
+            (-4, -4, -1, -1),  # completely outside
+        ]:
+            hist = cli._histogram(box)
+            assert hist.tolist() == image.crop(box).histogram(), box
+
+
+class TestMouseDrag(IsolatedAsyncioTestCase):
+
+    @mock.patch("asyncio.sleep", new_callable=mock.AsyncMock)
+    async def test_line(self, sleep: mock.AsyncMock) -> None:
+        cli = client.VNCDoToolClient()
+        cli.pointerEvent = mock.AsyncMock()  # type: ignore[method-assign]
+        await cli.mouseDrag(4, 2)
+        moves = [c.args[:2] for c in cli.pointerEvent.call_args_list]
+        # steps along the longer axis, with y rounded to the nearest pixel
+        assert moves == [(1, 0), (2, 1), (3, 2), (4, 2)]
+        assert (cli.x, cli.y) == (4, 2)
+
+    @mock.patch("asyncio.sleep", new_callable=mock.AsyncMock)
+    async def test_step(self, sleep: mock.AsyncMock) -> None:
+        cli = client.VNCDoToolClient()
+        cli.x, cli.y = 10, 10
+        cli.pointerEvent = mock.AsyncMock()  # type: ignore[method-assign]
+        await cli.mouseDrag(10, 0, step=3, step_delay=0.1)
+        moves = [c.args[:2] for c in cli.pointerEvent.call_args_list]
+        assert moves == [(10, 7), (10, 3), (10, 0)]
+        assert sleep.await_count == 2
+
+
+class TestVMWareClient(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = cli = client.VMWareClient()
+        cli.framebufferUpdateRequest = mock.AsyncMock()  # type: ignore[method-assign]
+        cli._handler = mock.AsyncMock()
+
+    async def test_single_pixel_update(self) -> None:
+        await self.client.dataReceived(self.client.SINGLE_PIXLE_UPDATE)
+        self.client.framebufferUpdateRequest.assert_awaited_once_with()
+        self.client._handler.assert_awaited_once_with()
+
+    async def test_other_data(self) -> None:
+        await self.client.dataReceived(bytes(20))
+        self.client.framebufferUpdateRequest.assert_not_awaited()
+        self.client._handler.assert_awaited_once_with()
@@ -1,4 +1,5 @@
-from unittest import TestCase, mock
+import zlib
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
 
 from vncdotool import rfb
 
@@ -75,3 +76,163 @@ class TestRFB(TestCase):
             mock.call(b"\x01"),  # AuthTypes.NONE
             mock.call(b"\x00"),  # shared
         ])
+
+
+class TestZRLE(TestCase):
+
+    def test_unpack_bits(self) -> None:
+        indices = rfb._zrle_unpack_indices(b"\xa5\x0f", 1, 8, 2)
+        assert indices.tolist() == [[1, 0, 1, 0, 0, 1, 0, 1], [0, 0, 0, 0, 1, 1, 1, 1]]
+
+    def test_unpack_dibits(self) -> None:
+        indices = rfb._zrle_unpack_indices(b"\x1b", 2, 4, 1)
+        assert indices.tolist() == [[0, 1, 2, 3]]
+
+    def test_unpack_nibbles(self) -> None:
+        indices = rfb._zrle_unpack_indices(b"\x12\x34", 4, 4, 1)
+        assert indices.tolist() == [[1, 2, 3, 4]]
+
+    def test_unpack_rows_padded(self) -> None:
+        # 3 pixels per row use one byte each, the remaining bits are padding
+        indices = rfb._zrle_unpack_indices(b"\xa0\x5f", 1, 3, 2)
+        assert indices.tolist() == [[1, 0, 1], [0, 1, 0]]
+        assert rfb._zrle_packed_size(1, 3, 2) == 2
+
+    def test_run_length(self) -> None:
+        data = bytearray(b"\x00\xff\xff\x02\x07")
+        assert rfb._zrle_run_length(data, 0) == (1, 1)
+        assert rfb._zrle_run_length(data, 1) == (1 + 255 + 255 + 2, 4)
+
+    def test_rle_tile(self) -> None:
+        # red x2, green x1
+        data = bytearray(b"\xff\x00\x00\x01\x00\xff\x00\x00")
+        pixels, pos = rfb._zrle_rle_tile(data, 0, 3)
+        assert pixels.tolist() == [[255, 0, 0, 255]] * 2 + [[0, 255, 0, 255]]
+        assert pos == 8
+
+    def test_palette_rle_tile(self) -> None:
+        palette = rfb._zrle_cpixels(b"\x01\x02\x03\x04\x05\x06", 0, 2)
+        pixels, pos = rfb._zrle_rle_tile(bytearray(b"\x81\x01\x00"), 0, 3, palette)
+        assert pixels.tolist() == [[4, 5, 6, 255]] * 2 + [[1, 2, 3, 255]]
+        assert pos == 3
+
+    def test_inflate_chunked(self) -> None:
+        client = rfb.RFBClient()
+        data = bytes(range(256)) * 1024
+        compress = zlib.compressobj()
+        first = compress.compress(data[:100000]) + compress.flush(zlib.Z_SYNC_FLUSH)
+        second = compress.compress(data[100000:]) + compress.flush(zlib.Z_SYNC_FLUSH)
+        # the stream spans rectangles and the output buffer has to grow
+        n = client._inflateZRLE(first)
+        assert client._zrle_out[:n] == data[:100000]
+        n = client._inflateZRLE(second)
+        assert client._zrle_out[:n] == data[100000:]
+
+
+class TestPixelFormat(TestCase):
+    RGB32 = rfb.PixelFormat(32, 24, False, True, 255, 255, 255, 0, 8, 16)
+    BGR32 = rfb.PixelFormat(32, 24, False, True, 255, 255, 255, 16, 8, 0)
+    RGB24 = rfb.PixelFormat(24, 24, False, True, 255, 255, 255, 0, 8, 16)
+    BGR16 = rfb.PixelFormat(16, 16, False, True, 31, 63, 31, 11, 5, 0)
+
+    def test_convert_shifts(self) -> None:
+        data = self.RGB32.convert_to(self.BGR32, b"\x01\x02\x03\x00\x0a\x0b\x0c\x00")
+        assert data == b"\x03\x02\x01\x00\x0c\x0b\x0a\x00"
+
+    def test_convert_24bpp(self) -> None:
+        data = self.RGB32.convert_to(self.RGB24, b"\x01\x02\x03\x00")
+        assert data == b"\x01\x02\x03"
+        assert self.RGB24.convert_to(self.RGB32, data) == b"\x01\x02\x03\x00"
+
+    def test_convert_scales(self) -> None:
+        # white, pure red and pure blue in RGB565
+        data = self.BGR16.convert_to(self.RGB24, b"\xff\xff\x00\xf8\x1f\x00")
+        assert data == b"\xff\xff\xff\xff\x00\x00\x00\x00\xff"
+
+    def test_convert_palette(self) -> None:
+        palette = rfb.PixelFormat(8, 8, False, False, 0, 0, 0, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            palette.convert_to(self.RGB32, b"\x00")
+
+
+class TestLookup(TestCase):
+
+    def test_known(self) -> None:
+        assert rfb.Encoding.lookup(16) is rfb.Encoding.ZRLE
+        assert rfb.Encoding.lookup(0xFFFFFF11) is rfb.Encoding.PSEUDO_CURSOR
+
+    def test_unknown(self) -> None:
+        assert rfb.MsgS2C.lookup(99) == "<MsgS2C.UNKNOWN: 63>"
+
+
+class TestHextile(TestCase):
+
+    def test_subrects(self) -> None:
+        # x=1 y=2 w=3 h=4, then x=15 y=15 w=1 h=1
+        rects = rfb._hextile_subrects(b"\x12\x23\xff\x00", 2)
+        assert rects == [[1, 2, 4, 6], [15, 15, 16, 16]]
+
+    def test_subrects_coloured(self) -> None:
+        rects = rfb._hextile_subrects(b"\xaa\xbb\x12\x23", 4)
+        assert rects == [[1, 2, 4, 6]]
+
+
+class TestVncDes(TestCase):
+
+    def test_key_bits_reversed(self) -> None:
+        # "\x01" -> 0x80, "t" 0x74 -> 0x2e, padded with zero bytes
+        assert rfb._vnc_des("\x01t") == b"\x80\x2e" + bytes(6)
+
+
+class TestReceiveBuffer(TestCase):
+
+    def test_compact(self) -> None:
+        client = rfb.RFBClient()
+        client._packet += b"abcdef"
+        client._packet_read = 4
+        client._appendPacket(b"gh")
+        assert client._packet == b"efgh"
+        assert client._packet_read == 0
+
+    def test_leaked_view(self) -> None:
+        client = rfb.RFBClient()
+        client._packet += b"abcdef"
+        client._packet_read = 1
+        leaked = memoryview(client._packet)[:2]
+        # the buffer cannot grow while the view exists, so it is replaced
+        client._appendPacket(b"gh")
+        assert client._packet[client._packet_read :] == b"bcdefgh"
+        client._packet_read = 6
+        client._appendPacket(b"ij")
+        assert client._packet[client._packet_read :] == b"hij"
+        assert leaked == b"ab"
+
+
+class TestEmptyRectangle(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = client = rfb.RFBClient()
+        client._handler = client._handleExpected
+        client.pixel_format = rfb.PixelFormat()
+        client.updateRectangle = mock.AsyncMock()  # type: ignore[method-assign]
+
+    async def decode(self, encoding: rfb.Encoding, payload: bytes) -> None:
+        self.client._packet += (
+            b"\x00\x00\x00\x01"  # FramebufferUpdate, 1 rectangle
+            + rfb._RECTANGLE.pack(3, 4, 0, 0, encoding)
+            + payload
+        )
+        await self.client.expect(self.client._handleConnection, 1)
+        await self.client._handleExpected()
+        # the whole message is consumed and the next one is awaited
+        assert self.client._packet_read == len(self.client._packet)
+        assert self.client._expected_handler == self.client._handleConnection
+
+    async def test_hextile(self) -> None:
+        await self.decode(rfb.Encoding.HEXTILE, b"")
+        self.client.updateRectangle.assert_not_called()
+
+    async def test_rre_with_subrects(self) -> None:
+        subrect = b"\x01\x02\x03\x04" + bytes(8)
+        await self.decode(rfb.Encoding.RRE, b"\x00\x00\x00\x01" + bytes(4) + subrect)
+        self.client.updateRectangle.assert_not_called()
@@ -8,12 +8,14 @@ MIT License
 
 import asyncio
 import logging
-import math
+import os
 import socket
 import time
 from pathlib import Path
 from struct import pack
-from typing import IO, Any, List, Optional, TypeVar, Union
+from typing import IO, Any, Dict, List, Optional, Tuple, TypeVar, Union
+
+import numpy as np
 from PIL import Image
 
 from . import rfb
@@ -23,6 +25,9 @@ TFile = Union[str, Path, IO[bytes]]
 
 log = logging.getLogger(__name__)
 
+# filename -> (mtime, size, histogram) of images used with expectScreen/Region
+_EXPECT_CACHE: Dict[str, Tuple[int, Tuple[int, int], List[int], np.ndarray]] = {}
+
 
 KEYMAP = {
     "bsp": rfb.KEY_BackSpace,
@@ -124,12 +129,62 @@ PF2IM = {
 }
 
 
+def _pf_key(pf: rfb.PixelFormat) -> Tuple[int, ...]:
+    return (
+        pf.bpp,
+        pf.depth,
+        pf.bigendian,
+        pf.truecolor,
+        pf.redmax,
+        pf.greenmax,
+        pf.bluemax,
+        pf.redshift,
+        pf.greenshift,
+        pf.blueshift,
+    )
+
+
+PF2IM_BY_KEY = {_pf_key(pf): mode for pf, mode in PF2IM.items()}
+
+# RGB888 for every BGR16 pixel value, scaled like Pillow's "BGR;16" raw mode
+_px16 = np.arange(0x10000, dtype=np.uint32)
+_BGR16_LUT = np.stack(
+    (
+        (_px16 >> 11) * 255 // 31,
+        ((_px16 >> 5) & 63) * 255 // 63,
+        (_px16 & 31) * 255 // 31,
+    ),
+    axis=-1,
+).astype(np.uint8)
+del _px16
+
+
+# image mode -> (bytes per pixel, slice selecting R, G, B) for byte-aligned formats
+_RAW_LAYOUT = {
+    "RGB": (3, slice(0, 3)),
+    "BGR": (3, slice(2, None, -1)),
+    "RGBX": (4, slice(0, 3)),
+    "BGRX": (4, slice(2, None, -1)),
+}
+
+
+def _unpack_bgr16(data: rfb.Buffer, width: int, height: int) -> np.ndarray:
+    """Convert little-endian BGR16 pixels to an (height, width, 3) RGB array"""
+    return _BGR16_LUT[np.frombuffer(data, dtype="<u2").reshape(height, width)]
+
+
+def _rects_intersect(rects: List[rfb.Rect], box: rfb.Rect) -> bool:
+    """Check if any update rectangle (x, y, w, h) overlaps the box (x0, y0, x1, y1)"""
+    x, y, w, h = np.array(rects, dtype=np.int64).reshape(-1, 4).T
+    x0, y0, x1, y1 = box
+    return bool(((x < x1) & (x0 < x + w) & (y < y1) & (y0 < y + h)).any())
+
+
 class VNCDoToolClient(rfb.RFBClient):
     encoding: rfb.Encoding
     x: int
     y: int
     buttons: int
-    screen: Optional[Image.Image]
     image_mode: str
     cursor: Optional[Image.Image]
     cmask: Optional[Image.Image]
@@ -137,12 +192,15 @@ class VNCDoToolClient(rfb.RFBClient):
     nchannels: int
     frequency: int
 
-    SPECIAL_KEYS_US = '~!@#$%^&*()_+{}|:"<>?'
+    SPECIAL_KEYS_US = frozenset('~!@#$%^&*()_+{}|:"<>?')
     MAX_DESKTOP_SIZE = 0x1000
 
+    # decoded keysyms per (key, force_caps), shared by all clients
+    _decode_cache: Dict[Tuple[str, bool], Tuple[int, ...]] = {}
+
     def __init__(self):
         super().__init__()
-        self.updateCommited = asyncio.Event()
+        self._commit_fut: Optional["asyncio.Future[None]"] = None
         self.pseudocursor = False
         self.nocursor = False
         self.pseudodesktop = True
@@ -154,25 +212,83 @@ class VNCDoToolClient(rfb.RFBClient):
         self.x = 0
         self.y = 0
         self.buttons = 0
-        self.screen = None
-        self.image_mode = PF2IM[rfb.PixelFormat()]
+        self._fb: Optional[np.ndarray] = None  # RGB framebuffer, shape (h, w, 3)
+        self._screen: Optional[Image.Image] = None  # rendered from _fb on demand
+        # rectangles updated since the last expect comparison, None if unknown
+        self._pending_rects: Optional[List[rfb.Rect]] = None
+        self.image_mode = PF2IM_BY_KEY[_pf_key(rfb.PixelFormat())]
         self.cursor = None
         self.cmask = None
+        self._cursor_key: Optional[Tuple[Any, ...]] = None
         self.sample_format = rfb.SampleFormat.S16
         self.nchannels = 2
         self.frequency = 44100
 
-    def _decodeKey(self, key: str) -> List[int]:
+    @property
+    def screen(self) -> Optional[Image.Image]:
+        """The current display as image, including the cursor"""
+        if self._screen is None and self._fb is not None:
+            screen = Image.fromarray(self._fb)
+            if self.cursor:
+                x = self.x - self.cfocus[0]
+                y = self.y - self.cfocus[1]
+                screen.paste(self.cursor, (x, y), self.cmask)
+            self._screen = screen
+        return self._screen
+
+    @screen.setter
+    def screen(self, image: Optional[Image.Image]) -> None:
+        self._fb = None if image is None else np.array(image.convert("RGB"))
+        self._screen = None
+
+    def _resizeFramebuffer(self, width: int, height: int) -> np.ndarray:
+        fb = np.zeros((height, width, 3), dtype=np.uint8)
+        if self._fb is not None:
+            h = min(height, self._fb.shape[0])
+            w = min(width, self._fb.shape[1])
+            fb[:h, :w] = self._fb[:h, :w]
+        self._fb = fb
+        self._screen = None
+        return fb
+
+    def _histogram(self, box: rfb.Rect) -> np.ndarray:
+        """Histogram of the screen region like Image.histogram() of its crop"""
+        if self.cursor:
+            screen = self.screen
+            assert screen is not None
+            return np.asarray(screen.crop(box).histogram())
+
+        assert self._fb is not None
+        x0, y0, x1, y1 = box
+        # negative indices would wrap around
+        region = self._fb[max(y0, 0) : max(y1, 0), max(x0, 0) : max(x1, 0)]
+        hist = np.empty(3 * 256, dtype=np.int64)
+        for c in range(3):
+            hist[c * 256 : (c + 1) * 256] = np.bincount(
+                region[..., c].ravel(), minlength=256
+            )
+        # crop() pads the area outside of the screen with black
+        hist[::256] += (x1 - x0) * (y1 - y0) - region.shape[0] * region.shape[1]
+        return hist
+
+    def _decodeKey(self, key: str) -> Tuple[int, ...]:
+        ck = (key, self.force_caps)
+        cached = self._decode_cache.get(ck)
+        if cached is not None:
+            return cached
+
         if self.force_caps:
             if key.isupper() or key in self.SPECIAL_KEYS_US:
                 key = "shift-%c" % key.lower()
 
         if len(key) == 1:
-            keys = [key]
+            # KEYMAP only has names, single characters map to their code point
+            cached = (ord(key),)
         else:
-            keys = key.split("-")
+            cached = tuple(KEYMAP.get(k) or ord(k) for k in key.split("-"))
 
-        return [KEYMAP.get(k) or ord(k) for k in keys]
+        self._decode_cache[ck] = cached
+        return cached
 
     async def pause(self, duration: float):
         await asyncio.sleep(duration)
@@ -183,27 +299,33 @@ class VNCDoToolClient(rfb.RFBClient):
         key: string: either [a-z] or a from KEYMAP
         """
         keys = self._decodeKey(key)
-        log.debug("keyPress %s", keys)
-        for k in keys:
-            await self.keyEvent(k, down=True)
-        for k in reversed(keys):
-            await self.keyEvent(k, down=False)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("keyPress %s", keys)
+        with self.writeBatch():
+            for k in keys:
+                await self.keyEvent(k, down=True)
+            for k in reversed(keys):
+                await self.keyEvent(k, down=False)
 
         return self
 
     async def keyDown(self: TClient, key: str) -> TClient:
         keys = self._decodeKey(key)
-        log.debug("keyDown %s", keys)
-        for k in keys:
-            await self.keyEvent(k, down=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("keyDown %s", keys)
+        with self.writeBatch():
+            for k in keys:
+                await self.keyEvent(k, down=True)
 
         return self
 
     async def keyUp(self: TClient, key: str) -> TClient:
         keys = self._decodeKey(key)
-        log.debug("keyUp %s", keys)
-        for k in keys:
-            await self.keyEvent(k, down=False)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("keyUp %s", keys)
+        with self.writeBatch():
+            for k in keys:
+                await self.keyEvent(k, down=False)
 
         return self
 
@@ -225,7 +347,8 @@ class VNCDoToolClient(rfb.RFBClient):
         button: int: [1-n]
 
         """
-        log.debug("mouseDown %s", button)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("mouseDown %s", button)
         self.buttons |= 1 << (button - 1)
         await self.pointerEvent(self.x, self.y, buttonmask=self.buttons)
 
@@ -237,7 +360,8 @@ class VNCDoToolClient(rfb.RFBClient):
         button: int: [1-n]
 
         """
-        log.debug("mouseUp %s", button)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("mouseUp %s", button)
         self.buttons &= ~(1 << (button - 1))
         await self.pointerEvent(self.x, self.y, buttonmask=self.buttons)
 
@@ -256,9 +380,13 @@ class VNCDoToolClient(rfb.RFBClient):
         return self._capture(fp, incremental, x, y, x + w, y + h)
 
     async def refreshScreen(self: TClient, incremental: bool = False) -> TClient:
-        self.updateCommited.clear()
+        # resolved by the next commitUpdate(), shared by concurrent waiters
+        fut = self._commit_fut
+        if fut is None or fut.done():
+            fut = self._commit_fut = asyncio.get_running_loop().create_future()
         await self.framebufferUpdateRequest(incremental=incremental)
-        await self.updateCommited.wait()
+        # shielded, so a cancelled waiter does not cancel it for the others
+        await asyncio.shield(fut)
         return self
 
     async def _capture(self, fp: TFile, incremental: bool, *args: int):
@@ -300,59 +428,84 @@ class VNCDoToolClient(rfb.RFBClient):
         return self
 
     async def _expectFramebuffer(self, filename: str, x: int, y: int, maxrms: float):
-        image = Image.open(filename)
-        w, h = image.size
-        self.expected = image.histogram()
+        mtime = os.stat(filename).st_mtime_ns
+        cached = _EXPECT_CACHE.get(filename)
+        if cached is None or cached[0] != mtime:
+            with Image.open(filename) as image:
+                hist = image.histogram()
+                cached = (mtime, image.size, hist, np.asarray(hist, dtype=np.int64))
+            _EXPECT_CACHE[filename] = cached
+        _, (w, h), self.expected, self._expected_np = cached
 
         await self._expectCompare((x, y, x + w, y + h), maxrms)
 
     async def _expectCompare(self, box: rfb.Rect, maxrms: float):
         incremental = False
-        if self.screen:
-            incremental = True
-            image = self.screen.crop(box)
-
-            hist = image.histogram()
-            if len(hist) == len(self.expected):
-                sum_ = sum((h - e) ** 2 for h, e in zip(hist, self.expected))
-                rms = math.sqrt(sum_ / len(hist))
-
-                log.debug("rms:%f maxrms:%f", rms, maxrms)
-                if rms <= maxrms:
-                    return
-
-        await self.framebufferUpdateRequest(
-            incremental=incremental
-        )  # use box ~(x, y, w - x, h - y)?
-        await self.updateCommited.wait()
-        await self._expectCompare(box, maxrms)
+        expected = self._expected_np
+        expected_len = len(expected)
+        # rms <= maxrms  <=>  sum of squares <= maxrms**2 * n
+        max_sum = maxrms * maxrms * expected_len
+        self._pending_rects = None
+        try:
+            while True:
+                # only re-check when an update since the last check touched the region
+                if self._fb is not None and (
+                    self._pending_rects is None
+                    or _rects_intersect(self._pending_rects, box)
+                ):
+                    incremental = True
+                    hist = self._histogram(box)
+                    if len(hist) == expected_len:
+                        diff = hist - expected
+                        sum_ = int((diff * diff).sum())
+
+                        if log.isEnabledFor(logging.DEBUG):
+                            rms = (sum_ / expected_len) ** 0.5
+                            log.debug("rms:%f maxrms:%f", rms, maxrms)
+                        if sum_ <= max_sum:
+                            return
+
+                # collect the rectangles of all updates until the next check
+                self._pending_rects = []
+                # use box ~(x, y, w - x, h - y)?
+                await self.refreshScreen(incremental=incremental)
+        finally:
+            self._pending_rects = None
 
     async def mouseMove(self: TClient, x: int, y: int) -> TClient:
         """Move the mouse pointer to position (x, y)"""
-        log.debug("mouseMove %d,%d", x, y)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("mouseMove %d,%d", x, y)
         self.x, self.y = x, y
         await self.pointerEvent(x, y, self.buttons)
         return self
 
-    async def mouseDrag(self: TClient, x: int, y: int, step: int = 1) -> TClient:
-        """Move the mouse point to position (x, y) in increments of step"""
-        log.debug("mouseDrag %d,%d", x, y)
-        if x < self.x:
-            xsteps = range(self.x - step, x, -step)
-        else:
-            xsteps = range(self.x + step, x, step)
+    async def mouseDrag(
+        self: TClient, x: int, y: int, step: int = 1, step_delay: float = 0
+    ) -> TClient:
+        """Move the mouse point in a straight line to position (x, y)
+        in increments of step
 
-        if y < self.y:
-            ysteps = range(self.y - step, y, -step)
+        step_delay: seconds to pause after each step; by default all
+                    intermediate moves are sent at once
+        """
+        log.debug("mouseDrag %d,%d", x, y)
+        # straight line, steps are taken along the longer axis
+        x0, y0 = self.x, self.y
+        n = max(abs(x - x0), abs(y - y0)) // step
+        steps = [
+            (x0 + round((x - x0) * i / n), y0 + round((y - y0) * i / n))
+            for i in range(1, n)
+        ]
+
+        if step_delay:
+            for xpos, ypos in steps:
+                await self.mouseMove(xpos, ypos)
+                await asyncio.sleep(step_delay)
         else:
-            ysteps = range(self.y + step, y, step)
-
-        for ypos in ysteps:
-            await self.mouseMove(self.x, ypos)
-            await asyncio.sleep(0.2)
-
-        for xpos in xsteps:
-            await self.mouseMove(xpos, self.y)
+            with self.writeBatch():
+                for xpos, ypos in steps:
+                    await self.mouseMove(xpos, ypos)
             await asyncio.sleep(0.2)
 
         await self.mouseMove(x, y)
@@ -362,7 +515,7 @@ class VNCDoToolClient(rfb.RFBClient):
     async def setImageMode(self) -> None:
         """Check support for PixelFormats announced by server or select client supported alternative."""
         try:
-            self.image_mode = PF2IM[self.pixel_format]
+            self.image_mode = PF2IM_BY_KEY[_pf_key(self.pixel_format)]
         except LookupError:
             if self._version_server == (3, 889):  # Apple Remote Desktop
                 pixel_format = BGR16
@@ -370,7 +523,7 @@ class VNCDoToolClient(rfb.RFBClient):
                 pixel_format = RGB32
 
             await self.setPixelFormat(pixel_format)
-            self.image_mode = PF2IM[pixel_format]
+            self.image_mode = PF2IM_BY_KEY[_pf_key(pixel_format)]
 
     #
     # base customizations
@@ -423,75 +576,131 @@ class VNCDoToolClient(rfb.RFBClient):
         await self.clientCutText(message)
         return self
 
-    async def updateRectangle(
-        self, x: int, y: int, width: int, height: int, data: bytes
-    ) -> None:
-        # ignore empty updates
-        if not data:
-            return
-
+    async def beginUpdate(self) -> None:
+        # allocate the whole canvas at the announced size, so a first update sent
+        # in several rectangles does not have to grow it repeatedly
+        if self._fb is None:
+            self._resizeFramebuffer(self.width, self.height)
+
+    def _decodePixels(self, data: rfb.Buffer, width: int, height: int) -> np.ndarray:
+        """Convert pixels in the negotiated format to a height*width*3 RGB array."""
+        layout = _RAW_LAYOUT.get(self.image_mode)
+        if layout is not None:
+            bypp, rgb = layout
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, bypp)
+            return pixels[..., rgb]
+        if self.image_mode == "BGR;16":
+            return _unpack_bgr16(data, width, height)
         size = (width, height)
-        update = Image.frombytes("RGB", size, data, "raw", self.image_mode)
-        if not self.screen:
-            self.screen = update
+        return np.asarray(Image.frombytes("RGB", size, data, "raw", self.image_mode))
+
+    def _framebufferFor(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Return the framebuffer, grown to contain the given rectangle."""
+        fb = self._fb
+        if fb is None:  # not within a framebuffer update
+            fb = self._resizeFramebuffer(x + width, y + height)
         # track upward screen resizes, often occurs during os boot of VMs
         # When the screen is sent in chunks (as observed on VMWare ESXi), the canvas
         # needs to be resized to fit all existing contents and the update.
-        elif self.screen.size[0] < (x + width) or self.screen.size[1] < (y + height):
+        elif fb.shape[1] < (x + width) or fb.shape[0] < (y + height):
             new_size = (
-                max(x + width, self.screen.size[0]),
-                max(y + height, self.screen.size[1]),
+                max(x + width, fb.shape[1]),
+                max(y + height, fb.shape[0]),
             )
-            await self.mouseMove(new_size[0] * 2, new_size[1] * 2)
-            await self.mouseMove(0, 0)
-            new_screen = Image.new("RGB", new_size, "black")
-            new_screen.paste(self.screen, (0, 0))
-            new_screen.paste(update, (x, y))
-            self.screen = new_screen
-        else:
-            self.screen.paste(update, (x, y))
+            fb = self._resizeFramebuffer(*new_size)
+            # request the grown area with the next update, too
+            self.width, self.height = new_size
+        return fb
+
+    async def updateRectangle(
+        self, x: int, y: int, width: int, height: int, data: rfb.Buffer
+    ) -> None:
+        # ignore empty updates
+        if not data:
+            return
+
+        update = self._decodePixels(data, width, height)
+        fb = self._framebufferFor(x, y, width, height)
+        fb[y : y + height, x : x + width] = update
+        self._screen = None
+
+        await self.drawCursor()
+
+    async def fillRectangle(
+        self, x: int, y: int, width: int, height: int, color: bytes
+    ) -> None:
+        # ignore empty updates
+        if not width or not height:
+            return
+
+        # convert the single pixel and let NumPy broadcast it over the area,
+        # instead of building width*height pixels first
+        (rgb,) = self._decodePixels(color, 1, 1)
+        fb = self._framebufferFor(x, y, width, height)
+        fb[y : y + height, x : x + width] = rgb
+        self._screen = None
 
         await self.drawCursor()
 
     async def commitUpdate(self, rectangles: Optional[List[rfb.Rect]] = None) -> None:
-        self.updateCommited.set()
+        if self._pending_rects is not None:
+            if rectangles is None:
+                self._pending_rects = None
+            else:
+                self._pending_rects += rectangles
+        fut, self._commit_fut = self._commit_fut, None
+        if fut is not None and not fut.done():
+            fut.set_result(None)
 
     async def updateCursor(
-        self, x: int, y: int, width: int, height: int, image: bytes, mask: bytes
+        self,
+        x: int,
+        y: int,
+        width: int,
+        height: int,
+        image: rfb.Buffer,
+        mask: rfb.Buffer,
     ) -> None:
         if self.nocursor:
             return
 
         if not width or not height:
             self.cursor = None
+            self._cursor_key = None
+            self._screen = None
+            # the cursor is part of the screen, but it has no update rectangle
+            self._pending_rects = None
+            return
+
+        key = (x, y, width, height, self.image_mode, image, mask)
+        if key == self._cursor_key:
+            return
 
-        self.cursor = Image.frombytes(
-            "RGB", (width, height), image, "raw", self.image_mode
-        )
-        self.cmask = Image.frombytes("1", (width, height), mask)
+        size = (width, height)
+        if self.cursor and self.cmask and self.cursor.size == size:
+            self.cursor.frombytes(image, "raw", self.image_mode)
+            self.cmask.frombytes(mask)
+        else:
+            self.cursor = Image.frombytes("RGB", size, image, "raw", self.image_mode)
+            self.cmask = Image.frombytes("1", size, mask)
+        self._cursor_key = key[:5] + (bytes(image), bytes(mask))
         self.cfocus = x, y
+        self._pending_rects = None  # compare again, see above
         await self.drawCursor()
 
     async def drawCursor(self) -> None:
         if not self.cursor:
             return
 
-        if not self.screen:
-            return
-
-        x = self.x - self.cfocus[0]
-        y = self.y - self.cfocus[1]
-        self.screen.paste(self.cursor, (x, y), self.cmask)
+        # the cursor is overlaid when the screen image is rendered next
+        self._screen = None
 
     async def updateDesktopSize(self, width: int, height: int) -> None:
         if not (
             0 <= width < self.MAX_DESKTOP_SIZE and 0 <= height < self.MAX_DESKTOP_SIZE
         ):
             raise ValueError((width, height))
-        new_screen = Image.new("RGB", (width, height), "black")
-        if self.screen:
-            new_screen.paste(self.screen, (0, 0))
-        self.screen = new_screen
+        self._resizeFramebuffer(width, height)
 
 
 class VMWareClient(VNCDoToolClient):
@@ -507,6 +716,8 @@ class VMWareClient(VNCDoToolClient):
         rfb.Encoding.RAW,  # encoding-type
         # pixel-data
     )
+    _SP_HEAD = SINGLE_PIXLE_UPDATE[0]
+    _SP_TAIL = SINGLE_PIXLE_UPDATE[2:16]
 
     async def dataReceived(self, data: bytes) -> None:
         # BUG: TCP is a *stream* orianted protocol with no *framing*.
@@ -514,10 +725,10 @@ class VMWareClient(VNCDoToolClient):
         # This might also match inside any other sequence if fragmentation by chance puts it at be start of a new packet.
         if (
             len(data) == 20
-            and data[0] == self.SINGLE_PIXEL_UPDATE[0]
-            and data[2:16] == self.SINGLE_PIXEL_UPDATE[2:16]
+            and data[0] == self._SP_HEAD
+            and memoryview(data)[2:16] == self._SP_TAIL
         ):
             await self.framebufferUpdateRequest()
-            self._handler()
+            await self._handler()
         else:
             await super().dataReceived(data)
@@ -14,13 +14,17 @@ MIT License
 
 import asyncio
 import getpass
+import hashlib
 import os
 import sys
 import zlib
 import logging as log
-from dataclasses import astuple, dataclass
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from enum import IntEnum, IntFlag
-from struct import Struct, pack, unpack, unpack_from
+from functools import cached_property
+from struct import Struct, pack
 from typing import (
     Any,
     Awaitable,
@@ -32,15 +36,41 @@ from typing import (
     List,
     Optional,
     Tuple,
+    Union,
     cast,
 )
 
+import numpy as np
 from Cryptodome.Cipher import AES, DES
-from Cryptodome.Hash import MD5
-from Cryptodome.Util.number import bytes_to_long, long_to_bytes
 
 Rect = Tuple[int, int, int, int]
 Ver = Tuple[int, int]
+Handler = Callable[..., Awaitable[None]]
+# received data is handed around as views into the receive buffer
+Buffer = Union[bytes, bytearray, memoryview]
+
+_SET_PIXEL_FORMAT = Struct("!Bxxx16s")
+_FRAMEBUFFER_UPDATE_REQUEST = Struct("!BBHHHH")
+_KEY_EVENT = Struct("!BBxxI")
+_POINTER_EVENT = Struct("!BBHH")
+_CLIENT_CUT_TEXT = Struct("!BxxxI")
+_QEMU_AUDIO = Struct("!BBH")
+_QEMU_AUDIO_BEGIN = Struct("!BBHBBIBBH")
+
+# read from the server in chunks of up to this size
+_READ_SIZE = 65536
+
+# Pre-compiled formats for the fixed-width message headers
+_U8 = Struct("!B")
+_U16 = Struct("!H")
+_U32 = Struct("!I")
+_HH = Struct("!HH")
+_SERVER_INIT = Struct("!HH16sI")
+_FRAMEBUFFER_UPDATE = Struct("!xH")
+_RECTANGLE = Struct("!HHHHi")
+_COLOUR_MAP = Struct("!xHH")
+_COLOUR = Struct("!HHH")
+_CUT_TEXT = Struct("!xxxI")
 
 # ~ from twisted.internet import reactor
 
@@ -48,7 +78,10 @@ Ver = Tuple[int, int]
 class IntEnumLookup(IntEnum):
     @classmethod
     def lookup(cls, value: int) -> object:
-        return cls._value2member_map_.get(value, f"<{cls.__name__}.UNKNOWN: {value:x}>")
+        member = cls._value2member_map_.get(value)
+        if member is None:  # only format the placeholder when it is needed
+            return f"<{cls.__name__}.UNKNOWN: {value:x}>"
+        return member
 
 
 class Encoding(IntEnumLookup):
@@ -348,6 +381,9 @@ KEY_BackSlash = 0x005C
 KEY_SpaceBar = 0x0020
 
 
+_PIXEL_FORMATS: Dict[Tuple[type, bytes], "PixelFormat"] = {}
+
+
 @dataclass(frozen=True)
 class PixelFormat:
     """RFC 6143 §7.4. Pixel Format Data Structure"""
@@ -387,54 +423,174 @@ class PixelFormat:
         return (7 + self.bpp) // 8
 
     @classmethod
-    def from_bytes(cls, block: bytes) -> "PixelFormat":
-        return cls(*cls.STRUCT.unpack(block))
+    def from_bytes(cls, block: Buffer) -> "PixelFormat":
+        # only a handful of formats are in use, share the (immutable) instances
+        key = (cls, bytes(block))
+        try:
+            return _PIXEL_FORMATS[key]
+        except KeyError:
+            pixel_format = _PIXEL_FORMATS[key] = cls(*cls.STRUCT.unpack(block))
+            return pixel_format
+
+    @cached_property
+    def _packed(self) -> bytes:
+        return self.STRUCT.pack(
+            self.bpp,
+            self.depth,
+            self.bigendian,
+            self.truecolor,
+            self.redmax,
+            self.greenmax,
+            self.bluemax,
+            self.redshift,
+            self.greenshift,
+            self.blueshift,
+        )
 
     def to_bytes(self) -> bytes:
-        return cast(bytes, self.STRUCT.pack(*astuple(self)))
-
-
-# ZRLE helpers
-def _zrle_next_bit(it: Iterator[int], pixels_in_tile: int) -> Iterator[int]:
-    num_pixels = 0
-    while True:
-        b = next(it)
+        return self._packed
+
+    def _dtype(self) -> np.dtype:
+        order = ">" if self.bigendian else "<"
+        return np.dtype(f"{order}u{4 if self.bypp == 3 else self.bypp}")
+
+    def convert_to(self, dst: "PixelFormat", buf: Buffer) -> bytes:
+        """Convert true color pixel data from this format to the format dst."""
+        if not (self.truecolor and dst.truecolor):
+            raise ValueError("Only true color pixel formats can be converted")
+        if self == dst:
+            return bytes(buf)
+
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        if self.bypp == 3:
+            raw = raw.reshape(-1, 3).astype(np.uint32)
+            if self.bigendian:
+                raw = raw[:, ::-1]
+            src = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        else:
+            src = raw.view(self._dtype()).astype(np.uint32)
 
-        for n in range(8):
-            value = b >> (7 - n)
-            yield value & 1
+        out = np.zeros(src.shape, dtype=np.uint32)
+        for smax, sshift, dmax, dshift in (
+            (self.redmax, self.redshift, dst.redmax, dst.redshift),
+            (self.greenmax, self.greenshift, dst.greenmax, dst.greenshift),
+            (self.bluemax, self.blueshift, dst.bluemax, dst.blueshift),
+        ):
+            value = (src >> sshift) & smax
+            if smax != dmax:  # rescale through a lookup table
+                lut = (np.arange(smax + 1, dtype=np.uint64) * dmax + smax // 2) // smax
+                value = lut.astype(np.uint32)[value]
+            out |= value << dshift
 
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
+        if dst.bypp == 3:
+            data = out.astype("<u4").view(np.uint8).reshape(-1, 4)[:, :3]
+            if dst.bigendian:
+                data = data[:, ::-1]
+            return data.tobytes()
+        return out.astype(dst._dtype()).tobytes()
 
 
-def _zrle_next_dibit(it: Iterator[int], pixels_in_tile: int) -> Iterator[int]:
-    num_pixels = 0
+# ZRLE helpers
+# palette index of each pixel packed into a byte, by bits per pixel
+_ZRLE_UNPACK = {
+    bits: (
+        np.arange(256, dtype=np.uint8)[:, None]
+        >> np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+    )
+    & ((1 << bits) - 1)
+    for bits in (1, 2, 4)
+}
+
+
+def _zrle_unpack_indices(packed: Buffer, bits: int, tw: int, th: int) -> np.ndarray:
+    """Unpack the palette indices of a packed palette tile.
+
+    Each row of the tile starts at a byte boundary, see RFC 6143 §7.7.5.
+    """
+    per_byte = 8 // bits
+    row_bytes = (tw + per_byte - 1) // per_byte
+    rows = np.frombuffer(packed, dtype=np.uint8, count=row_bytes * th).reshape(
+        th, row_bytes
+    )
+    return _ZRLE_UNPACK[bits][rows].reshape(th, row_bytes * per_byte)[:, :tw]
+
+
+def _zrle_cpixels(data: bytearray, pos: int, count: int) -> np.ndarray:
+    """Read count 3 byte CPIXELs at pos as (count, 4) RGBX pixels."""
+    pixels = np.empty((count, 4), dtype=np.uint8)
+    rgb = np.frombuffer(data, dtype=np.uint8, count=3 * count, offset=pos)
+    pixels[:, :3] = rgb.reshape(count, 3)
+    pixels[:, 3] = 0xFF
+    return pixels
+
+
+def _zrle_run_length(data: bytearray, pos: int) -> Tuple[int, int]:
+    """Read a ZRLE run length at pos, return it and the position after it."""
+    run_length = 1
     while True:
-        b = next(it)
-
-        for n in range(0, 8, 2):
-            value = b >> (6 - n)
-            yield value & 3
+        value = data[pos]
+        pos += 1
+        run_length += value
+        if value != 255:
+            return run_length, pos
+
+
+def _hextile_subrects(block: Buffer, stride: int) -> List[List[int]]:
+    """Decode the hextile subrects, each ending with its x-and-y-position and
+    width-and-height byte, into [x0, y0, x1, y1] tile coordinates."""
+    xy, wh = np.frombuffer(block, dtype=np.uint8).reshape(-1, stride)[:, -2:].T
+    x0 = xy >> 4
+    y0 = xy & 0xF
+    return np.stack((x0, y0, x0 + (wh >> 4) + 1, y0 + (wh & 0xF) + 1), axis=1).tolist()
+
+
+def _zrle_rle_tile(
+    data: bytearray, pos: int, count: int, palette: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, int]:
+    """Decode count pixels of a plain RLE tile, or of a palette RLE tile if a
+    palette is given, at pos. Return the (count, 4) RGBX pixels and the position
+    after the tile."""
+    values = []
+    runs = []
+    num_pixels = 0
+    while num_pixels < count:
+        if palette is None:
+            values.append(pos)  # offset of the CPIXEL
+            pos += 3
+            run_length, pos = _zrle_run_length(data, pos)
+        else:
+            value = data[pos]
+            pos += 1
+            values.append(value & 0x7F)
+            if value & 0x80:
+                # run of length > 1, more bytes follow to determine run length
+                run_length, pos = _zrle_run_length(data, pos)
+            else:
+                run_length = 1
+        runs.append(run_length)
+        num_pixels += run_length
+    if num_pixels != count:
+        raise ValueError("too many pixels")
 
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
+    if palette is None:
+        offsets = np.array(values)[:, None] + np.arange(3)
+        colors = np.empty((len(values), 4), dtype=np.uint8)
+        colors[:, :3] = np.frombuffer(data, dtype=np.uint8)[offsets]
+        colors[:, 3] = 0xFF
+    else:
+        colors = palette[values]
+    return np.repeat(colors, runs, axis=0), pos
 
 
-def _zrle_next_nibble(it: Iterator[int], pixels_in_tile: int) -> Iterator[int]:
-    num_pixels = 0
-    while True:
-        b = next(it)
+# inflate ZRLE data in steps of this size, so it stays cache resident
+_ZRLE_INFLATE_CHUNK = 8192
+# inflate rectangles with at least this much compressed data in a worker thread
+_ZRLE_INFLATE_THREADED = 65536
 
-        for n in range(0, 8, 4):
-            value = b >> (4 - n)
-            yield value & 15
 
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
+def _zrle_packed_size(bits: int, tw: int, th: int) -> int:
+    per_byte = 8 // bits
+    return (tw + per_byte - 1) // per_byte * th
 
 
 class RFBClient:  # type: ignore[misc]
@@ -469,8 +625,7 @@ class RFBClient:  # type: ignore[misc]
         Encoding.PSEUDO_QEMU_AUDIO
     }
 
-    _HEADER = b"RFB 000.000\n"
-    _HEADER_TRANSLATE = bytes.maketrans(b"0123456789", b"0" * 10)
+    _HEADER = b"RFB 000.000\n"  # 0 stands for any digit
 
     _expected_handler: Callable[..., Awaitable[None]]
 
@@ -482,14 +637,39 @@ class RFBClient:  # type: ignore[misc]
 
     def __init__(self) -> None:
         self._packet = bytearray()
+        self._packet_read = 0  # start of unconsumed data in _packet
         self._handler = self._handleInitial
         self._expected_len = 12
         self._expected_args: Tuple[Any, ...] = ()
         self._expected_kwargs: Dict[str, Any] = {}
-        self._already_expecting = False
         self._version: Ver = (0, 0)
         self._version_server: Ver = (0, 0)
         self._zlib_stream = zlib.decompressobj(0)
+        self._zrle_out = bytearray(65536)  # reused inflate buffer, grows as needed
+        self._zrle_executor: Optional[ThreadPoolExecutor] = None
+        # pixels of the RRE, CoRRE or hextile rectangle being decoded
+        self._canvas = np.empty((0, 0, 4), dtype=np.uint8)
+        # message-type -> (handler, length of the rest of the header)
+        self._message_handlers: Dict[int, Tuple[Handler, int]] = {
+            MsgS2C.FRAMEBUFFER_UPDATE: (self._handleFramebufferUpdate, 3),
+            MsgS2C.SET_COLOUR_MAP_ENTRIES: (self._handleColourMapEntries, 5),
+            MsgS2C.BELL: (self._handleBell, 0),
+            MsgS2C.SERVER_CUT_TEXT: (self._handleServerCutText, 7),
+            MsgS2C.QEMU_SERVER_MESSAGE: (self._handleQEMUServerMessage, 1),
+        }
+        # encoding-type -> decoder started with (x, y, width, height)
+        self._rectangle_decoders: Dict[int, Handler] = {
+            Encoding.RAW: self._beginDecodeRAW,
+            Encoding.COPY_RECTANGLE: self._beginDecodeCopyrect,
+            Encoding.RRE: self._beginDecodeRRE,
+            Encoding.CORRE: self._beginDecodeCORRE,
+            Encoding.HEXTILE: self._beginDecodeHextile,
+            Encoding.ZRLE: self._beginDecodeZRLE,
+            Encoding.PSEUDO_CURSOR: self._beginDecodePsuedoCursor,
+            Encoding.PSEUDO_DESKTOP_SIZE: self._handleDecodeDesktopSize,
+            Encoding.PSEUDO_QEMU_EXTENDED_KEY_EVENT: self._handleQEMUExtendedKeyEvent,
+            Encoding.PSEUDO_QEMU_AUDIO: self._handleQEMUAudio,
+        }
         self.negotiated_encodings = {
             Encoding.RAW,
         }
@@ -500,11 +680,24 @@ class RFBClient:  # type: ignore[misc]
         self.receive_task: Optional[asyncio.Task[None]] = None
         self.writer = None
         self.reader = None
+        self._write_buf = bytearray()  # reused by writeBatch()
+        self._write_batch: Optional[bytearray] = None
 
     @property
     def bypp(self) -> int:
         return self.pixel_format.bypp
 
+    @property
+    def pixel_format(self) -> PixelFormat:
+        return self._pixel_format
+
+    @pixel_format.setter
+    def pixel_format(self, pixel_format: PixelFormat) -> None:
+        self._pixel_format = pixel_format
+        # layouts of the RRE and CoRRE subrectangles depend on the pixel size
+        self._rre_subrect = Struct(f"!{pixel_format.bypp}sHHHH")
+        self._corre_subrect = Struct(f"!{pixel_format.bypp}sBBBB")
+
     async def connect(
         self,
         reader: asyncio.StreamReader,
@@ -527,20 +720,48 @@ class RFBClient:  # type: ignore[misc]
         if self.writer:
             self.writer.close()
             self.writer = None
+        if self._zrle_executor:
+            self._zrle_executor.shutdown(wait=False)
+            self._zrle_executor = None
 
-    async def _write(self, data: bytes) -> None:
+    async def _write(self, data: Buffer) -> None:
+        if self._write_batch is not None:
+            self._write_batch += data
+            return
         if self.writer is None:
             return
         self.writer.write(data)
 
+    @contextmanager
+    def writeBatch(self) -> Iterator[None]:
+        """Collect all messages sent within the block and write them at once."""
+        if self._write_batch is not None:  # already batching
+            yield
+            return
+        batch = self._write_batch = self._write_buf
+        try:
+            yield
+        finally:
+            self._write_batch = None
+            # the transport may keep a reference, so never hand it the reused buffer
+            if batch and self.writer is not None:
+                self.writer.write(bytes(batch))
+            batch.clear()
+
     # ------------------------------------------------------
     # states used on connection startup
     # ------------------------------------------------------
 
     async def _handleInitial(self) -> None:
         head = self._packet[:12]
-        norm = head.translate(self._HEADER_TRANSLATE)
-        if norm == self._HEADER:
+        if (
+            len(head) == 12
+            and head[:4] == b"RFB "
+            and head[7:8] == b"."
+            and head[11:12] == b"\n"
+            and head[4:7].isdigit()
+            and head[8:11].isdigit()
+        ):
             version_server = (int(head[4:7]), int(head[8:11]))
             if version_server not in self.SUPPORTED_SERVER_VERSIONS:
                 log.debug("Protocol version %d.%d not supported" % version_server)
@@ -551,7 +772,7 @@ class RFBClient:  # type: ignore[misc]
             if version > self.MAX_CLIENT_VERSION:
                 version = self.MAX_CLIENT_VERSION
 
-            del self._packet[0:12]
+            self._packet_read = 12  # consumed like any other block
             log.debug("Using protocol version %d.%d" % version)
             await self._write(b"RFB %03d.%03d\n" % version)
             self._handler = self._handleExpected
@@ -561,25 +782,29 @@ class RFBClient:  # type: ignore[misc]
                 await self.expect(self._handleAuth, 4)
             else:
                 await self.expect(self._handleNumberSecurityTypes, 1)
-        elif not self._HEADER.startswith(norm):
+            await self._handleExpected()  # the server may have sent more already
+        elif not all(
+            c == h or (h == 0x30 and c in b"0123456789")
+            for c, h in zip(head, self._HEADER)
+        ):  # not even the start of a valid header
             log.debug(f"invalid initial server response {head!r}")
             await self.disconnect()
 
-    async def _handleNumberSecurityTypes(self, block: bytes) -> None:
-        (num_types,) = unpack("!B", block)
+    async def _handleNumberSecurityTypes(self, block: Buffer) -> None:
+        (num_types,) = _U8.unpack(block)
         if num_types:
             await self.expect(self._handleSecurityTypes, num_types)
         else:
             await self.expect(self._handleConnFailed, 4)
 
-    async def _handleSecurityTypes(self, block: bytes) -> None:
-        types = unpack(f"!{len(block)}B", block)
+    async def _handleSecurityTypes(self, block: Buffer) -> None:
+        types = tuple(block)
         for sec_type in types:
             log.debug(f"Offered {AuthTypes.lookup(sec_type)!r}")
         valid_types = set(types) & self.SUPPORTED_AUTHS
         if valid_types:
             sec_type = max(valid_types)
-            await self._write(pack("!B", sec_type))
+            await self._write(_U8.pack(sec_type))
             if sec_type == AuthTypes.NONE:
                 if self._version < (3, 8):
                     await self._doClientInitialization()
@@ -593,8 +818,8 @@ class RFBClient:  # type: ignore[misc]
             log.debug(f"unknown security types: {types!r}")
             await self.disconnect()
 
-    async def _handleAuth(self, block: bytes) -> None:
-        (auth,) = unpack("!I", block)
+    async def _handleAuth(self, block: Buffer) -> None:
+        (auth,) = _U32.unpack(block)
         # ~ print(f"{auth=}")
         if auth == AuthTypes.INVALID:
             await self.expect(self._handleConnFailed, 4)
@@ -606,29 +831,29 @@ class RFBClient:  # type: ignore[misc]
             log.debug(f"unknown auth response {AuthTypes.lookup(auth)!r}")
             await self.disconnect()
 
-    async def _handleConnFailed(self, block: bytes) -> None:
-        (waitfor,) = unpack("!I", block)
+    async def _handleConnFailed(self, block: Buffer) -> None:
+        (waitfor,) = _U32.unpack(block)
         await self.expect(self._handleConnMessage, waitfor)
 
-    async def _handleConnMessage(self, block: bytes) -> None:
-        log.debug(f"Connection refused: {block!r}")
+    async def _handleConnMessage(self, block: Buffer) -> None:
+        log.debug(f"Connection refused: {bytes(block)!r}")
         await self.disconnect()
 
-    async def _handleVNCAuth(self, block: bytes) -> None:
-        self._challenge = block
+    async def _handleVNCAuth(self, block: Buffer) -> None:
+        self._challenge = bytes(block)
         await self.vncRequestPassword()
         await self.expect(self._handleVNCAuthResult, 4)
 
-    async def _handleDHAuth(self, block: bytes) -> None:
-        self.generator, self.keyLen = unpack("!HH", block)
+    async def _handleDHAuth(self, block: Buffer) -> None:
+        self.generator, self.keyLen = _HH.unpack(block)
         await self.expect(self._handleDHAuthKey, self.keyLen)
 
-    async def _handleDHAuthKey(self, block: bytes) -> None:
-        self.modulus = block
+    async def _handleDHAuthKey(self, block: Buffer) -> None:
+        self.modulus = bytes(block)
         await self.expect(self._handleDHAuthCert, self.keyLen)
 
-    async def _handleDHAuthCert(self, block: bytes) -> None:
-        self.serverKey = block
+    async def _handleDHAuthCert(self, block: Buffer) -> None:
+        self.serverKey = bytes(block)
 
         await self.ardRequestCredentials()
 
@@ -638,17 +863,16 @@ class RFBClient:  # type: ignore[misc]
     async def _encryptArd(self) -> None:
         userStruct = f"{self.username:\0<64}{self.password:\0<64}"
 
-        s = bytes_to_long(os.urandom(512))
+        s = int.from_bytes(os.urandom(512), "big")
         g = self.generator
-        m = bytes_to_long(self.modulus)
-        sk = bytes_to_long(self.serverKey)
+        m = int.from_bytes(self.modulus, "big")
+        sk = int.from_bytes(self.serverKey, "big")
 
-        key = long_to_bytes(pow(g, s, m))
-        shared = long_to_bytes(pow(sk, s, m))
+        # both values are sent and hashed with the full key length
+        key = pow(g, s, m).to_bytes(self.keyLen, "big")
+        shared = pow(sk, s, m).to_bytes(self.keyLen, "big")
 
-        h = MD5.new()
-        h.update(shared)
-        keyDigest = h.digest()
+        keyDigest = hashlib.md5(shared).digest()
 
         cipher = AES.new(keyDigest, AES.MODE_ECB)
         ciphertext = cipher.encrypt(userStruct.encode("utf-8"))
@@ -667,8 +891,8 @@ class RFBClient:  # type: ignore[misc]
         response = des.encrypt(self._challenge)
         await self._write(response)
 
-    async def _handleVNCAuthResult(self, block: bytes) -> None:
-        (result,) = unpack("!I", block)
+    async def _handleVNCAuthResult(self, block: Buffer) -> None:
+        (result,) = _U32.unpack(block)
         # ~ print(f"{auth=}")
         if result == 0:  # OK
             await self._doClientInitialization()
@@ -689,26 +913,26 @@ class RFBClient:  # type: ignore[misc]
             log.debug(f"unknown auth response ({result})")
             await self.disconnect()
 
-    async def _handleAuthFailed(self, block: bytes) -> None:
-        (waitfor,) = unpack("!I", block)
+    async def _handleAuthFailed(self, block: Buffer) -> None:
+        (waitfor,) = _U32.unpack(block)
         await self.expect(self._handleAuthFailedMessage, waitfor)
 
-    async def _handleAuthFailedMessage(self, block: bytes) -> None:
-        await self.vncAuthFailed(block)
+    async def _handleAuthFailedMessage(self, block: Buffer) -> None:
+        await self.vncAuthFailed(bytes(block))
         await self.disconnect()
 
     async def _doClientInitialization(self) -> None:
-        await self._write(pack("!B", self.shared))
+        await self._write(_U8.pack(self.shared))
         await self.expect(self._handleServerInit, 24)
 
-    async def _handleServerInit(self, block: bytes) -> None:
-        (self.width, self.height, pixformat, namelen) = unpack("!HH16sI", block)
+    async def _handleServerInit(self, block: Buffer) -> None:
+        (self.width, self.height, pixformat, namelen) = _SERVER_INIT.unpack(block)
         self.pixel_format = PixelFormat.from_bytes(pixformat)
         log.debug(f"Native {self.pixel_format} bytes={self.pixel_format.bypp}")
         await self.expect(self._handleServerName, namelen)
 
-    async def _handleServerName(self, block: bytes) -> None:
-        self.name = block
+    async def _handleServerName(self, block: Buffer) -> None:
+        self.name = bytes(block)
         # callback:
         await self.vncConnectionMade()
         await self.expect(self._handleConnection, 1)
@@ -716,33 +940,30 @@ class RFBClient:  # type: ignore[misc]
     # ------------------------------------------------------
     # Server to client messages
     # ------------------------------------------------------
-    async def _handleConnection(self, block: bytes) -> None:
-        (msgid,) = unpack("!B", block)
-        if msgid == MsgS2C.FRAMEBUFFER_UPDATE:
-            await self.expect(self._handleFramebufferUpdate, 3)
-        elif msgid == MsgS2C.SET_COLOUR_MAP_ENTRIES:
-            await self.expect(self._handleColourMapEntries, 5)
-        elif msgid == MsgS2C.BELL:
-            await self.bell()
-            await self.expect(self._handleConnection, 1)
-        elif msgid == MsgS2C.SERVER_CUT_TEXT:
-            await self.expect(self._handleServerCutText, 7)
-        elif msgid == MsgS2C.QEMU_SERVER_MESSAGE:
-            await self.expect(self._handleQEMUServerMessage, 1)
-        else:
+    async def _handleConnection(self, block: Buffer) -> None:
+        msgid = block[0]
+        try:
+            handler, size = self._message_handlers[msgid]
+        except KeyError:
             log.debug(f"unknown message received {MsgS2C.lookup(msgid)!r}")
             await self.disconnect()
+        else:
+            await self.expect(handler, size)
+
+    async def _handleBell(self, block: Buffer) -> None:
+        await self.bell()
+        await self.expect(self._handleConnection, 1)
 
-    async def _handleQEMUServerMessage(self, block: bytes) -> None:
-        (smsgid,) = unpack("!B", block)
+    async def _handleQEMUServerMessage(self, block: Buffer) -> None:
+        (smsgid,) = _U8.unpack(block)
         if smsgid == 1:
             await self.expect(self._handleQEMUAudioServerMessage, 2)
         else:
             log.debug(f"unknown QEMU message received {smsgid!r}")
             await self.disconnect()
 
-    async def _handleQEMUAudioServerMessage(self, block: bytes) -> None:
-        (op,) = unpack("!H", block)
+    async def _handleQEMUAudioServerMessage(self, block: Buffer) -> None:
+        (op,) = _U16.unpack(block)
         if op == 0:
             await self.audio_stream_end()
             await self.expect(self._handleConnection, 1)
@@ -755,18 +976,20 @@ class RFBClient:  # type: ignore[misc]
             log.debug(f"unknown QEMU audio op received {op!r}")
             await self.disconnect()
 
-    async def _handleQEMUAudioServerProviderMessage(self, block: bytes) -> None:
-        (size,) = unpack("!I", block)
+    async def _handleQEMUAudioServerProviderMessage(self, block: Buffer) -> None:
+        (size,) = _U32.unpack(block)
         await self.expect(self._handleQEMUAudioServerStreamMessage, size, size)
 
     async def _handleQEMUAudioServerStreamMessage(
-        self, block: bytes, size: int
+        self, block: Buffer, size: int
     ) -> None:
-        await self.audio_stream_data(size, block)
+        await self.audio_stream_data(size, bytes(block))
         await self.expect(self._handleConnection, 1)
 
-    async def _handleFramebufferUpdate(self, block: bytes) -> None:
-        (self.rectangles,) = unpack("!xH", block)
+    async def _handleFramebufferUpdate(self, block: Buffer) -> None:
+        (self.rectangles,) = _FRAMEBUFFER_UPDATE.unpack(block)
+        # not preallocated: with LastRect the count is just 0xFFFF, and the list
+        # is handed to commitUpdate(), which may keep it
         self.rectanglePos: List[Rect] = []
         await self.beginUpdate()
         await self._doConnection()
@@ -779,66 +1002,49 @@ class RFBClient:  # type: ignore[misc]
                 await self.commitUpdate(self.rectanglePos)
             await self.expect(self._handleConnection, 1)
 
-    async def _handleRectangle(self, block: bytes) -> None:
-        (x, y, width, height, encoding) = unpack("!HHHHi", block)
-        log.debug(f"x={x} y={y} w={width} h={height} {Encoding.lookup(encoding)!r}")
+    async def _handleRectangle(self, block: Buffer) -> None:
+        (x, y, width, height, encoding) = _RECTANGLE.unpack(block)
+        if log.root.isEnabledFor(log.DEBUG):
+            log.debug(
+                "x=%d y=%d w=%d h=%d %r", x, y, width, height, Encoding.lookup(encoding)
+            )
         if encoding == Encoding.PSEUDO_LAST_RECT:
             self.rectangles = 0
 
         if self.rectangles:
             self.rectangles -= 1
             self.rectanglePos.append((x, y, width, height))
-            if encoding == Encoding.COPY_RECTANGLE:
-                await self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
-            elif encoding == Encoding.RAW:
-                await self.expect(
-                    self._handleDecodeRAW,
-                    width * height * self.bypp,
-                    x,
-                    y,
-                    width,
-                    height,
-                )
-            elif encoding == Encoding.HEXTILE:
-                await self._doNextHextileSubrect(
-                    None, None, x, y, width, height, None, None
-                )
-            elif encoding == Encoding.CORRE:
-                await self.expect(
-                    self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height
-                )
-            elif encoding == Encoding.RRE:
-                await self.expect(
-                    self._handleDecodeRRE, 4 + self.bypp, x, y, width, height
-                )
-            elif encoding == Encoding.ZRLE:
-                await self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
-            elif encoding == Encoding.PSEUDO_CURSOR:
-                length = width * height * self.bypp
-                length += ((width + 7) // 8) * height
-                await self.expect(
-                    self._handleDecodePsuedoCursor, length, x, y, width, height
-                )
-            elif encoding == Encoding.PSEUDO_DESKTOP_SIZE:
-                await self._handleDecodeDesktopSize(width, height)
-            elif encoding == Encoding.PSEUDO_QEMU_EXTENDED_KEY_EVENT:
-                self.negotiated_encodings.add(Encoding.PSEUDO_QEMU_EXTENDED_KEY_EVENT)
-                del self.rectanglePos[-1]  # undo append as this is no real update
-                await self._doConnection()
-            elif encoding == Encoding.PSEUDO_QEMU_AUDIO:
-                self.negotiated_encodings.add(Encoding.PSEUDO_QEMU_AUDIO)
-                del self.rectanglePos[-1]
-                await self._doConnection()
-            else:
+            try:
+                decoder = self._rectangle_decoders[encoding]
+            except KeyError:
                 log.debug(f"unknown encoding received {Encoding.lookup(encoding)!r}")
                 await self.disconnect()
+            else:
+                await decoder(x, y, width, height)
         else:
             await self._doConnection()
 
+    async def _handleQEMUExtendedKeyEvent(
+        self, x: int, y: int, width: int, height: int
+    ) -> None:
+        self.negotiated_encodings.add(Encoding.PSEUDO_QEMU_EXTENDED_KEY_EVENT)
+        del self.rectanglePos[-1]  # undo append as this is no real update
+        await self._doConnection()
+
+    async def _handleQEMUAudio(self, x: int, y: int, width: int, height: int) -> None:
+        self.negotiated_encodings.add(Encoding.PSEUDO_QEMU_AUDIO)
+        del self.rectanglePos[-1]
+        await self._doConnection()
+
     # ---  RAW Encoding
 
+    async def _beginDecodeRAW(self, x: int, y: int, width: int, height: int) -> None:
+        await self.expect(
+            self._handleDecodeRAW, width * height * self.bypp, x, y, width, height
+        )
+
     async def _handleDecodeRAW(
-        self, block: bytes, x: int, y: int, width: int, height: int
+        self, block: Buffer, x: int, y: int, width: int, height: int
     ) -> None:
         # TODO convert pixel format?
         await self.updateRectangle(x, y, width, height, block)
@@ -846,70 +1052,100 @@ class RFBClient:  # type: ignore[misc]
 
     # ---  CopyRect Encoding
 
+    async def _beginDecodeCopyrect(
+        self, x: int, y: int, width: int, height: int
+    ) -> None:
+        await self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
+
     async def _handleDecodeCopyrect(
-        self, block: bytes, x: int, y: int, width: int, height: int
+        self, block: Buffer, x: int, y: int, width: int, height: int
     ) -> None:
-        (srcx, srcy) = unpack("!HH", block)
+        (srcx, srcy) = _HH.unpack(block)
         await self.copyRectangle(srcx, srcy, x, y, width, height)
         await self._doConnection()
 
+    # ---  RRE, CoRRE and Hextile: subrects are drawn into one canvas
+
+    def _beginCanvas(
+        self, width: int, height: int, color: Optional[bytes] = None
+    ) -> None:
+        self._canvas = np.empty((height, width, self.bypp), dtype=np.uint8)
+        if color is not None:
+            self._canvas[...] = np.frombuffer(color, dtype=np.uint8)
+
+    async def _commitCanvas(self, x: int, y: int) -> None:
+        """hand over the decoded rectangle with a single updateRectangle()"""
+        if self._canvas.size == 0:  # empty rectangles are allowed
+            return
+        height, width = self._canvas.shape[:2]
+        await self.updateRectangle(x, y, width, height, self._canvas.data.cast("B"))
+
     # ---  RRE Encoding
 
+    async def _beginDecodeRRE(self, x: int, y: int, width: int, height: int) -> None:
+        await self.expect(self._handleDecodeRRE, 4 + self.bypp, x, y, width, height)
+
     async def _handleDecodeRRE(
-        self, block: bytes, x: int, y: int, width: int, height: int
+        self, block: Buffer, x: int, y: int, width: int, height: int
     ) -> None:
-        (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        await self.fillRectangle(x, y, width, height, color)
+        (subrects,) = _U32.unpack_from(block)
+        color = bytes(block[4:])
         if subrects:
+            self._beginCanvas(width, height, color)
             await self.expect(
                 self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y
             )
         else:
+            await self.fillRectangle(x, y, width, height, color)
             await self._doConnection()
 
-    async def _handleRRESubRectangles(self, block: bytes, topx: int, topy: int) -> None:
+    async def _handleRRESubRectangles(
+        self, block: Buffer, topx: int, topy: int
+    ) -> None:
         # ~ print("_handleRRESubRectangle")
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 8
-        format = f"!{self.bypp}sHHHH"
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos : pos + sz])
-            await self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        canvas = self._canvas
+        for color, x, y, width, height in self._rre_subrect.iter_unpack(block):
+            canvas[y : y + height, x : x + width] = np.frombuffer(color, dtype=np.uint8)
+        await self._commitCanvas(topx, topy)
         await self._doConnection()
 
     # ---  CoRRE Encoding
 
+    async def _beginDecodeCORRE(self, x: int, y: int, width: int, height: int) -> None:
+        await self.expect(self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height)
+
     async def _handleDecodeCORRE(
-        self, block: bytes, x: int, y: int, width: int, height: int
+        self, block: Buffer, x: int, y: int, width: int, height: int
     ) -> None:
-        (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        await self.fillRectangle(x, y, width, height, color)
+        (subrects,) = _U32.unpack_from(block)
+        color = bytes(block[4:])
         if subrects:
+            self._beginCanvas(width, height, color)
             await self.expect(
                 self._handleDecodeCORRERectangles, (4 + self.bypp) * subrects, x, y
             )
         else:
+            await self.fillRectangle(x, y, width, height, color)
             await self._doConnection()
 
     async def _handleDecodeCORRERectangles(
-        self, block: bytes, topx: int, topy: int
+        self, block: Buffer, topx: int, topy: int
     ) -> None:
         # ~ print("_handleDecodeCORRERectangle")
-        pos = 0
-        sz = self.bypp + 4
-        format = "!{self.bypp}sBBBB"
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos : pos + sz])
-            await self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        canvas = self._canvas
+        for color, x, y, width, height in self._corre_subrect.iter_unpack(block):
+            canvas[y : y + height, x : x + width] = np.frombuffer(color, dtype=np.uint8)
+        await self._commitCanvas(topx, topy)
         await self._doConnection()
 
     # ---  Hexile Encoding
 
+    async def _beginDecodeHextile(
+        self, x: int, y: int, width: int, height: int
+    ) -> None:
+        self._beginCanvas(width, height)
+        await self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+
     async def _doNextHextileSubrect(
         self,
         bg: Optional[bytes],
@@ -939,6 +1175,8 @@ class RFBClient:  # type: ignore[misc]
             ty = y
         # more tiles?
         if ty >= y + height:
+            # all tiles are decoded, hand over the rectangle at once
+            await self._commitCanvas(x, y)
             await self._doConnection()
         else:
             await self.expect(
@@ -947,7 +1185,7 @@ class RFBClient:  # type: ignore[misc]
 
     async def _handleDecodeHextile(
         self,
-        block: bytes,
+        block: Buffer,
         bg: bytes,
         color: bytes,
         x: int,
@@ -989,7 +1227,7 @@ class RFBClient:  # type: ignore[misc]
             if subencoding & HextileEncoding.ANY_SUBRECTS:
                 numbytes += 1
             if numbytes:
-                await self.expect(
+                await self._expectBuffered(
                     self._handleDecodeHextileSubrect,
                     numbytes,
                     subencoding,
@@ -1005,12 +1243,12 @@ class RFBClient:  # type: ignore[misc]
                     th,
                 )
             else:
-                await self.fillRectangle(tx, ty, tw, th, bg)
+                self._fillHextile(tx - x, ty - y, tw, th, bg)
                 await self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
     async def _handleDecodeHextileSubrect(
         self,
-        block: bytes,
+        block: Buffer,
         subencoding: HextileEncoding,
         bg: bytes,
         color: bytes,
@@ -1026,11 +1264,11 @@ class RFBClient:  # type: ignore[misc]
         subrects = 0
         pos = 0
         if subencoding & HextileEncoding.BACKGROUND_SPECIFIED:
-            bg = block[: self.bypp]
+            bg = bytes(block[: self.bypp])
             pos += self.bypp
-        await self.fillRectangle(tx, ty, tw, th, bg)
+        self._fillHextile(tx - x, ty - y, tw, th, bg)
         if subencoding & HextileEncoding.FOREGROUND_SPECIFIED:
-            color = block[pos : pos + self.bypp]
+            color = bytes(block[pos : pos + self.bypp])
             pos += self.bypp
         if subencoding & HextileEncoding.ANY_SUBRECTS:
             # ~ (subrects, ) = unpack("!B", block)
@@ -1038,7 +1276,7 @@ class RFBClient:  # type: ignore[misc]
         # ~ print(subrects)
         if subrects:
             if subencoding & HextileEncoding.SUBRECTS_COLORED:
-                await self.expect(
+                await self._expectBuffered(
                     self._handleDecodeHextileSubrectsColoured,
                     (self.bypp + 2) * subrects,
                     bg,
@@ -1054,7 +1292,7 @@ class RFBClient:  # type: ignore[misc]
                     th,
                 )
             else:
-                await self.expect(
+                await self._expectBuffered(
                     self._handleDecodeHextileSubrectsFG,
                     2 * subrects,
                     bg,
@@ -1074,7 +1312,7 @@ class RFBClient:  # type: ignore[misc]
 
     async def _handleDecodeHextileRAW(
         self,
-        block: bytes,
+        block: Buffer,
         bg: bytes,
         color: bytes,
         x: int,
@@ -1087,12 +1325,16 @@ class RFBClient:  # type: ignore[misc]
         th: int,
     ) -> None:
         """the tile is in raw encoding"""
-        await self.updateRectangle(tx, ty, tw, th, block)
+        rx = tx - x
+        ry = ty - y
+        self._canvas[ry : ry + th, rx : rx + tw] = np.frombuffer(
+            block, dtype=np.uint8
+        ).reshape(th, tw, self.bypp)
         await self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
     async def _handleDecodeHextileSubrectsColoured(
         self,
-        block: bytes,
+        block: Buffer,
         bg: Optional[bytes],
         color: Optional[bytes],
         subrects: int,
@@ -1107,24 +1349,17 @@ class RFBClient:  # type: ignore[misc]
     ) -> None:
         """subrects with their own color"""
         sz = self.bypp + 2
-        pos = 0
-        end = len(block)
-        while pos < end:
-            pos2 = pos + self.bypp
-            color = block[pos:pos2]
-            xy = block[pos2]
-            wh = block[pos2 + 1]
-            sx = xy >> 4
-            sy = xy & 0xF
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xF) + 1
-            await self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += sz
+        colors = np.frombuffer(block, dtype=np.uint8).reshape(-1, sz)[:, :-2].copy()
+        tile = self._canvas[ty - y : ty - y + th, tx - x : tx - x + tw]
+        rects = _hextile_subrects(block, sz)
+        for (x0, y0, x1, y1), subrect_color in zip(rects, colors):
+            tile[y0:y1, x0:x1] = subrect_color
+        color = colors[-1].tobytes()
         await self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
     async def _handleDecodeHextileSubrectsFG(
         self,
-        block: bytes,
+        block: Buffer,
         bg: bytes,
         color: bytes,
         subrects: int,
@@ -1138,23 +1373,27 @@ class RFBClient:  # type: ignore[misc]
         th: int,
     ) -> None:
         """all subrect with same color"""
-        pos = 0
-        end = len(block)
-        while pos < end:
-            xy = block[pos]
-            wh = block[pos + 1]
-            sx = xy >> 4
-            sy = xy & 0xF
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xF) + 1
-            await self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += 2
+        fg = np.frombuffer(color, dtype=np.uint8)
+        tile = self._canvas[ty - y : ty - y + th, tx - x : tx - x + tw]
+        for x0, y0, x1, y1 in _hextile_subrects(block, 2):
+            tile[y0:y1, x0:x1] = fg
         await self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
+    def _fillHextile(
+        self, x: int, y: int, width: int, height: int, color: bytes
+    ) -> None:
+        """fill an area of the hextile rectangle, relative to its origin"""
+        self._canvas[y : y + height, x : x + width] = np.frombuffer(
+            color, dtype=np.uint8
+        )
+
     # ---  ZRLE Encoding
+    async def _beginDecodeZRLE(self, x: int, y: int, width: int, height: int) -> None:
+        await self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+
     async def _handleDecodeZRLE(
         self,
-        block: bytes,
+        block: Buffer,
         x: int,
         y: int,
         width: int,
@@ -1165,14 +1404,14 @@ class RFBClient:  # type: ignore[misc]
         See https://tools.ietf.org/html/rfc6143#section-7.7.6 (ZRLE)
         and https://tools.ietf.org/html/rfc6143#section-7.7.5 (TRLE)
         """
-        (compressed_bytes,) = unpack("!L", block)
+        (compressed_bytes,) = _U32.unpack(block)
         await self.expect(
             self._handleDecodeZRLEdata, compressed_bytes, x, y, width, height
         )
 
     async def _handleDecodeZRLEdata(
         self,
-        block: bytes,
+        block: Buffer,
         x: int,
         y: int,
         width: int,
@@ -1181,20 +1420,23 @@ class RFBClient:  # type: ignore[misc]
         tx = x
         ty = y
 
-        data = self._zlib_stream.decompress(block)
-        it = iter(data)
-
-        def cpixel(i: Iterator[int]) -> bytearray:
-            return bytearray(
-                (
-                    next(i),
-                    next(i),
-                    next(i),
-                    0xFF,
-                )
+        data = self._zrle_out
+        if len(block) >= _ZRLE_INFLATE_THREADED:
+            # zlib releases the GIL, so large rectangles do not block the event
+            # loop; the single worker keeps the stream's order. The block is
+            # copied because the receive buffer view is released on cancellation.
+            if self._zrle_executor is None:
+                self._zrle_executor = ThreadPoolExecutor(1, "vncdotool-zrle")
+            end = await asyncio.get_running_loop().run_in_executor(
+                self._zrle_executor, self._inflateZRLE, bytes(block)
             )
+        else:
+            end = self._inflateZRLE(block)
+        pos = 0
 
-        for subencoding in it:
+        while pos < end:
+            subencoding = data[pos]
+            pos += 1
             # calc tile size
             tw = th = 64
             if x + width - tx < 64:
@@ -1205,70 +1447,48 @@ class RFBClient:  # type: ignore[misc]
             pixels_in_tile = tw * th
 
             # decode next tile
-            num_pixels = 0
-            pixel_data = bytearray()
             palette_size = subencoding & 127
             if subencoding & 0x80:
                 # RLE
-
-                def do_rle(pixel: bytes) -> int:
-                    run_length_next = next(it)
-                    run_length = run_length_next
-                    while run_length_next == 255:
-                        run_length_next = next(it)
-                        run_length += run_length_next
-                    pixel_data.extend(pixel * (run_length + 1))
-                    return run_length + 1
-
                 if palette_size == 0:
                     # plain RLE
-                    while num_pixels < pixels_in_tile:
-                        color = cpixel(it)
-                        num_pixels += do_rle(color)
-                    if num_pixels != pixels_in_tile:
-                        raise ValueError("too many pixels")
+                    pixels, pos = _zrle_rle_tile(data, pos, pixels_in_tile)
                 else:
-                    palette = [cpixel(it) for p in range(palette_size)]
-
-                    while num_pixels < pixels_in_tile:
-                        palette_index = next(it)
-                        if palette_index & 0x80:
-                            palette_index &= 0x7F
-                            # run of length > 1, more bytes follow to determine run length
-                            num_pixels += do_rle(palette[palette_index])
-                        else:
-                            # run of length 1
-                            pixel_data.extend(palette[palette_index])
-                            num_pixels += 1
-                    if num_pixels != pixels_in_tile:
-                        raise ValueError("too many pixels")
-
-                await self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                    palette_rgbx = _zrle_cpixels(data, pos, palette_size)
+                    pos += 3 * palette_size
+                    pixels, pos = _zrle_rle_tile(
+                        data, pos, pixels_in_tile, palette_rgbx
+                    )
+                await self.updateRectangle(tx, ty, tw, th, pixels.data.cast("B"))
             else:
                 # No RLE
                 if palette_size == 0:
                     # Raw pixel data
-                    for _ in range(pixels_in_tile):
-                        pixel_data.extend(cpixel(it))
-                    await self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                    pixels = _zrle_cpixels(data, pos, pixels_in_tile)
+                    pos += 3 * pixels_in_tile
+                    await self.updateRectangle(tx, ty, tw, th, pixels.data.cast("B"))
                 elif palette_size == 1:
                     # Fill tile with plain color
-                    color = cpixel(it)
-                    await self.fillRectangle(tx, ty, tw, th, bytes(color))
+                    color = bytes(data[pos : pos + 3]) + b"\xff"  # CPIXEL + alpha
+                    pos += 3
+                    await self.fillRectangle(tx, ty, tw, th, color)
                 elif palette_size > 16:
                     raise ValueError(f"Palette of size {palette_size} is not allowed")
                 else:
-                    palette = [cpixel(it) for _ in range(palette_size)]
+                    palette_rgbx = _zrle_cpixels(data, pos, palette_size)
+                    pos += 3 * palette_size
                     if palette_size == 2:
-                        next_index = _zrle_next_bit(it, pixels_in_tile)
+                        bits = 1
                     elif palette_size == 3 or palette_size == 4:
-                        next_index = _zrle_next_dibit(it, pixels_in_tile)
+                        bits = 2
                     else:
-                        next_index = _zrle_next_nibble(it, pixels_in_tile)
+                        bits = 4
+                    size = _zrle_packed_size(bits, tw, th)
+                    indices = _zrle_unpack_indices(data[pos : pos + size], bits, tw, th)
+                    pos += size
 
-                    for palette_index in next_index:
-                        pixel_data.extend(palette[palette_index])
-                    await self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                    pixels = palette_rgbx[indices]
+                    await self.updateRectangle(tx, ty, tw, th, pixels.data.cast("B"))
 
             # Next tile
             tx = tx + 64
@@ -1278,9 +1498,31 @@ class RFBClient:  # type: ignore[misc]
 
         await self._doConnection()
 
+    def _inflateZRLE(self, block: Buffer) -> int:
+        """Decompress into the reused output buffer and return the length."""
+        stream = self._zlib_stream
+        out = self._zrle_out
+        pos = 0
+        chunk = stream.decompress(block, _ZRLE_INFLATE_CHUNK)
+        while chunk:
+            end = pos + len(chunk)
+            out[pos:end] = chunk  # grows the buffer if needed
+            pos = end
+            if not stream.unconsumed_tail and len(chunk) < _ZRLE_INFLATE_CHUNK:
+                break
+            chunk = stream.decompress(stream.unconsumed_tail, _ZRLE_INFLATE_CHUNK)
+        return pos
+
     # --- Pseudo Cursor Encoding
+    async def _beginDecodePsuedoCursor(
+        self, x: int, y: int, width: int, height: int
+    ) -> None:
+        length = width * height * self.bypp
+        length += ((width + 7) // 8) * height
+        await self.expect(self._handleDecodePsuedoCursor, length, x, y, width, height)
+
     async def _handleDecodePsuedoCursor(
-        self, block: bytes, x: int, y: int, width: int, height: int
+        self, block: Buffer, x: int, y: int, width: int, height: int
     ) -> None:
         split = width * height * self.bypp
         image = block[:split]
@@ -1289,33 +1531,35 @@ class RFBClient:  # type: ignore[misc]
         await self._doConnection()
 
     # --- Pseudo Desktop Size Encoding
-    async def _handleDecodeDesktopSize(self, width: int, height: int) -> None:
+    async def _handleDecodeDesktopSize(
+        self, x: int, y: int, width: int, height: int
+    ) -> None:
+        self.width = width
+        self.height = height
         await self.updateDesktopSize(width, height)
         await self._doConnection()
 
     # ---  other server messages
 
-    async def _handleColourMapEntries(self, block: bytes) -> None:
-        (first_color, number_of_colors) = unpack("!xHH", block)
+    async def _handleColourMapEntries(self, block: Buffer) -> None:
+        (first_color, number_of_colors) = _COLOUR_MAP.unpack(block)
         await self.expect(
             self._handleColourMapEntriesValue, 6 * number_of_colors, first_color
         )
 
     async def _handleColourMapEntriesValue(
-        self, block: bytes, first_color: int
+        self, block: Buffer, first_color: int
     ) -> None:
-        colors = [
-            unpack_from("!HHH", block, offset) for offset in range(0, len(block), 6)
-        ]
+        colors = list(_COLOUR.iter_unpack(block))
         await self.set_color_map(first_color, cast(List[Tuple[int, int, int]], colors))
         await self.expect(self._handleConnection, 1)
 
-    async def _handleServerCutText(self, block: bytes) -> None:
-        (length,) = unpack("!xxxI", block)
+    async def _handleServerCutText(self, block: Buffer) -> None:
+        (length,) = _CUT_TEXT.unpack(block)
         await self.expect(self._handleServerCutTextValue, length)
 
-    async def _handleServerCutTextValue(self, block: bytes) -> None:
-        await self.copy_text(block.decode("iso-8859-1"))
+    async def _handleServerCutTextValue(self, block: Buffer) -> None:
+        await self.copy_text(str(block, "iso-8859-1"))
         await self.expect(self._handleConnection, 1)
 
     # ------------------------------------------------------
@@ -1328,26 +1572,63 @@ class RFBClient:  # type: ignore[misc]
             and self.writer
             and not self.writer.is_closing()
         ):
-            data = await self.reader.read(16)
+            missing = self._expected_len - (len(self._packet) - self._packet_read)
+            if self._handler == self._handleExpected and missing > _READ_SIZE:
+                # fetch the rest of a large block in one go
+                try:
+                    data = await self.reader.readexactly(missing)
+                except asyncio.IncompleteReadError:
+                    break
+            else:
+                data = await self.reader.read(_READ_SIZE)
             if not data:
                 break
+            self._appendPacket(data)
+            # process inline, so the expected size is current for the next read
+            await self.dataReceived(data)
+
+    def _appendPacket(self, data: bytes) -> None:
+        """Append to the receive buffer. Consumed data is dropped once that is at
+        least half of the buffer."""
+        packet = self._packet
+        read = self._packet_read
+        try:
+            if read and read * 2 >= len(packet):
+                del packet[:read]
+                self._packet_read = 0
+            packet.extend(data)
+        except BufferError:
+            # a view into the buffer outlived its handler and the buffer cannot
+            # be resized; leave it to that view and continue with a copy
+            self._packet = packet[read:]
+            self._packet_read = 0
             self._packet.extend(data)
-            asyncio.create_task(self.dataReceived(data))
 
     async def dataReceived(self, data: bytes) -> None:
+        """called with every chunk read, after it was appended to the buffer"""
         await self._handler()
 
     async def _handleExpected(self) -> None:
-        if len(self._packet) >= self._expected_len:
-            while len(self._packet) >= self._expected_len:
-                self._already_expecting = True
-                block = bytes(self._packet[: self._expected_len])
-                del self._packet[: self._expected_len]
-                # ~ log.debug(f"handle {block!r} with {self._expected_handler.__name__!r}")
+        while len(self._packet) - self._packet_read >= self._expected_len:
+            start = self._packet_read
+            end = self._packet_read = start + self._expected_len
+            # handlers get a view into the receive buffer, which is only valid
+            # until they return; anything kept beyond that must be copied
+            with memoryview(self._packet)[start:end] as block:
                 await self._expected_handler(
                     block, *self._expected_args, **self._expected_kwargs
                 )
-            self._already_expecting = False
+
+    async def _expectBuffered(self, handler: Handler, size: int, *args: Any) -> None:
+        """Like expect(), but call the handler right away when the data is
+        already buffered, without going back through _handleExpected()."""
+        start = self._packet_read
+        if len(self._packet) - start < size:
+            await self.expect(handler, size, *args)
+            return
+        end = self._packet_read = start + size
+        with memoryview(self._packet)[start:end] as block:
+            await handler(block, *args)
 
     async def expect(
         self,
@@ -1361,8 +1642,6 @@ class RFBClient:  # type: ignore[misc]
         self._expected_len = size
         self._expected_args = args
         self._expected_kwargs = kwargs
-        if not self._already_expecting:
-            await self._handleExpected()  # just in case that there is already enough data
 
     # ------------------------------------------------------
     # client -> server messages
@@ -1370,14 +1649,16 @@ class RFBClient:  # type: ignore[misc]
 
     async def setPixelFormat(self, pixel_format: PixelFormat) -> None:
         pixformat = pixel_format.to_bytes()
-        await self._write(pack("!Bxxx16s", 0, pixformat))
+        await self._write(_SET_PIXEL_FORMAT.pack(0, pixformat))
         self.pixel_format = pixel_format
 
     async def setEncodings(self, list_of_encodings: Collection[Encoding]) -> None:
-        await self._write(pack("!BxH", 2, len(list_of_encodings)))
+        num_encodings = len(list_of_encodings)
         for encoding in list_of_encodings:
             log.debug(f"Offering {encoding!r}")
-            await self._write(pack("!i", encoding))
+        await self._write(
+            pack(f"!BxH{num_encodings}i", 2, num_encodings, *list_of_encodings)
+        )
 
     async def framebufferUpdateRequest(
         self,
@@ -1391,37 +1672,44 @@ class RFBClient:  # type: ignore[misc]
             width = self.width - x
         if height is None:
             height = self.height - y
-        await self._write(pack("!BBHHHH", 3, incremental, x, y, width, height))
+        await self._write(
+            _FRAMEBUFFER_UPDATE_REQUEST.pack(3, incremental, x, y, width, height)
+        )
 
     async def audioStreamBeginRequest(
         self, sample_format: SampleFormat, nchannels=2, frequency=44100
     ) -> None:
+        # set the sample format, then start the stream
         await self._write(
-            pack("!BBHBBI", 255, 1, 2, sample_format, nchannels, frequency)
+            _QEMU_AUDIO_BEGIN.pack(
+                255, 1, 2, sample_format, nchannels, frequency, 255, 1, 0
+            )
         )
-        await self._write(pack("!BBH", 255, 1, 0))
 
     async def audioStreamStopRequest(self) -> None:
-        await self._write(pack("!BBH", 255, 1, 1))
+        await self._write(_QEMU_AUDIO.pack(255, 1, 1))
 
     async def keyEvent(self, key: int, down: bool = True) -> None:
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        await self._write(pack("!BBxxI", 4, down, key))
+        await self._write(_KEY_EVENT.pack(4, down, key))
 
     async def pointerEvent(self, x: int, y: int, buttonmask: int = 0) -> None:
         """Indicates either pointer movement or a pointer button press or release. The pointer is
         now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
         by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
         """
-        await self._write(pack("!BBHH", 5, buttonmask, x, y))
+        await self._write(_POINTER_EVENT.pack(5, buttonmask, x, y))
 
     async def clientCutText(self, message: str) -> None:
         """The client has new ISO 8859-1 (Latin-1) text in its cut buffer.
         (aka clipboard)
         """
         data = message.encode("iso-8859-1")
-        await self._write(pack("!BxxxI", 6, len(data)) + data)
+        message_data = bytearray(_CLIENT_CUT_TEXT.size + len(data))
+        _CLIENT_CUT_TEXT.pack_into(message_data, 0, 6, len(data))
+        message_data[_CLIENT_CUT_TEXT.size :] = data
+        await self._write(message_data)
 
     # ------------------------------------------------------
     # callbacks
@@ -1458,10 +1746,11 @@ class RFBClient:  # type: ignore[misc]
         rectangles."""
 
     async def updateRectangle(
-        self, x: int, y: int, width: int, height: int, data: bytes
+        self, x: int, y: int, width: int, height: int, data: Buffer
     ) -> None:
         """new bitmap data. data is a string in the pixel format set
-        up earlier."""
+        up earlier. It may be a view into the receive buffer, which is only
+        valid until this returns."""
 
     async def copyRectangle(
         self, srcx: int, srcy: int, x: int, y: int, width: int, height: int
@@ -1479,9 +1768,10 @@ class RFBClient:  # type: ignore[misc]
         await self.updateRectangle(x, y, width, height, color * width * height)
 
     async def updateCursor(
-        self, x: int, y: int, width: int, height: int, image: bytes, mask: bytes
+        self, x: int, y: int, width: int, height: int, image: Buffer, mask: Buffer
     ) -> None:
-        """New cursor, focuses at (x, y)"""
+        """New cursor, focuses at (x, y). image and mask may be views into the
+        receive buffer, which are only valid until this returns."""
 
     async def updateDesktopSize(self, width: int, height: int) -> None:
         """New desktop size of width*height."""
@@ -1508,6 +1798,10 @@ class RFBClient:  # type: ignore[misc]
         """Stop to send the audio stream."""
 
 
+# each byte value with its bit order reversed
+_BIT_REVERSED = bytes(int(f"{b:08b}"[::-1], 2) for b in range(256))
+
+
 def _vnc_des(password: str) -> bytes:
     """RFB protocol for authentication requires client to encrypt
     challenge sent by server with password using DES method. However,
@@ -1517,5 +1811,4 @@ def _vnc_des(password: str) -> bytes:
     key = pw.encode(
         "ASCII"
     )  # unspecified https://www.rfc-editor.org/rfc/rfc6143#section-7.2.2
-    key = bytes(sum((128 >> i) if (k & (1 << i)) else 0 for i in range(8)) for k in key)
-    return key
+    return key.translate(_BIT_REVERSED)